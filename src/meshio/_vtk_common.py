@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import numpy as np
 
 from ._common import num_nodes_per_cell, warn
@@ -68,6 +70,14 @@ vtk_to_meshio_type = {
 meshio_to_vtk_type = {v: k for k, v in vtk_to_meshio_type.items()}
 
 
+def _read_only(array):
+    array.setflags(write=False)
+    return array
+
+
+# The orderings are requested once per cell block, but there are only a few distinct
+# ones. Cache them; they are returned read-only so they can be shared safely.
+@lru_cache(maxsize=None)
 def vtk_to_meshio_order(vtk_type, dtype=int):
     # meshio uses the same node ordering as VTK for most cell types. However, for the
     # linear wedge, the ordering of the gmsh Prism [1] is adopted since this is found in
@@ -76,16 +86,36 @@ def vtk_to_meshio_order(vtk_type, dtype=int):
     # [1] http://gmsh.info/doc/texinfo/gmsh.html#Node-ordering
     # [2] https://vtk.org/doc/nightly/html/classvtkWedge.html
     if vtk_type == 13:
-        return np.array([0, 2, 1, 3, 5, 4], dtype=dtype)
+        return _read_only(np.array([0, 2, 1, 3, 5, 4], dtype=dtype))
     return None
 
 
+@lru_cache(maxsize=None)
 def meshio_to_vtk_order(meshio_type, dtype=int):
     if meshio_type == "wedge":
-        return np.array([0, 2, 1, 3, 5, 4], dtype=dtype)
+        return _read_only(np.array([0, 2, 1, 3, 5, 4], dtype=dtype))
     return None
 
 
+def _with_bounds(breaks, n):
+    # [0, *breaks, n] with a single allocation
+    out = np.empty(len(breaks) + 2, dtype=breaks.dtype)
+    out[0] = 0
+    out[1:-1] = breaks
+    out[-1] = n
+    return out
+
+
+def _reshape_connectivity(connectivity, first, last, n, vtk_type, dtype):
+    # Get the cells with n nodes each stored in connectivity[first:last], in meshio
+    # order. This reads the connectivity contiguously and copies it only once.
+    data = connectivity[first:last].reshape(-1, n)
+    new_order = vtk_to_meshio_order(vtk_type, dtype=dtype)
+    if new_order is None:
+        return data.copy()
+    return data[:, new_order]
+
+
 def vtk_cells_from_data(connectivity, offsets, types, cell_data_raw):
     # Translate it into the cells array.
     # `connectivity` is a one-dimensional vector with
@@ -96,13 +126,9 @@ def vtk_cells_from_data(connectivity, offsets, types, cell_data_raw):
 
     # identify cell blocks
     breaks = np.where(types[:-1] != types[1:])[0] + 1
-    # all cells with indices between start[k] and end[k] have the same type
-    start_end = list(
-        zip(
-            np.concatenate([[0], breaks]),
-            np.concatenate([breaks, [len(types)]]),
-        )
-    )
+    # all cells with indices between bounds[k] and bounds[k + 1] have the same type
+    bounds = _with_bounds(breaks, len(types))
+    start_end = list(zip(bounds[:-1], bounds[1:]))
 
     cells = []
     cell_data = {}
@@ -141,7 +167,7 @@ def vtk_cells_from_data(connectivity, offsets, types, cell_data_raw):
 
             # find where the cell blocks start and end
             b = np.diff(sizes)
-            c = np.concatenate([[0], np.where(b != 0)[0] + 1, [len(sizes)]])
+            c = _with_bounds(np.where(b != 0)[0] + 1, len(sizes))
 
             # Loop over all cell sizes, find all cells with this size, and assign
             # connectivity
@@ -149,13 +175,17 @@ def vtk_cells_from_data(connectivity, offsets, types, cell_data_raw):
                 items = np.arange(cell_block_start, cell_block_end)
                 sz = sizes[cell_block_start]
 
-                new_order = vtk_to_meshio_order(types[start], dtype=offsets.dtype)
-                if new_order is None:
-                    new_order = np.arange(sz, dtype=offsets.dtype)
-                new_order -= sz
-
-                indices = np.add.outer(start_cn[items + 1], new_order)
-                cells.append(CellBlock(meshio_type, connectivity[indices]))
+                # The cells are stored contiguously, so the connectivity can simply
+                # be reshaped.
+                data = _reshape_connectivity(
+                    connectivity,
+                    start_cn[cell_block_start],
+                    start_cn[cell_block_end],
+                    sz,
+                    types[start],
+                    offsets.dtype,
+                )
+                cells.append(CellBlock(meshio_type, data))
 
                 # Store cell data for this set of cells
                 for name, d in cell_data_raw.items():
@@ -166,13 +196,27 @@ def vtk_cells_from_data(connectivity, offsets, types, cell_data_raw):
             # Non-polygonal cell. Same number of nodes per cell makes everything easier.
             n = num_nodes_per_cell[meshio_type]
 
-            new_order = vtk_to_meshio_order(types[start], dtype=offsets.dtype)
-            if new_order is None:
-                new_order = np.arange(n, dtype=offsets.dtype)
-            new_order -= n
+            first_node = offsets[start] - n
+            if first_node >= 0 and np.all(np.diff(offsets[start:end]) == n):
+                # The cells are stored contiguously (the usual case), so the
+                # connectivity can simply be reshaped.
+                data = _reshape_connectivity(
+                    connectivity,
+                    first_node,
+                    offsets[end - 1],
+                    n,
+                    types[start],
+                    offsets.dtype,
+                )
+            else:
+                new_order = vtk_to_meshio_order(types[start], dtype=offsets.dtype)
+                if new_order is None:
+                    new_order = np.arange(n, dtype=offsets.dtype)
+                new_order = new_order - n
 
-            indices = np.add.outer(offsets[start:end], new_order)
-            cells.append(CellBlock(meshio_type, connectivity[indices]))
+                indices = np.add.outer(offsets[start:end], new_order)
+                data = connectivity[indices]
+            cells.append(CellBlock(meshio_type, data))
             for name, d in cell_data_raw.items():
                 if name not in cell_data:
                     cell_data[name] = []
@@ -3,10 +3,13 @@ I/O for VTU.
 <https://vtk.org/Wiki/VTK_XML_Formats>
 <https://vtk.org/wp-content/uploads/2015/04/file-formats.pdf>
 """
-import base64
+import io
+import os
 import re
+import struct
 import sys
-import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import numpy as np
 
@@ -17,6 +20,22 @@ from .._helpers import register_format
 from .._mesh import CellBlock, Mesh
 from .._vtk_common import meshio_to_vtk_order, meshio_to_vtk_type, vtk_cells_from_data
 
+# pybase64 is a drop-in replacement for base64 with SIMD-accelerated encoding and
+# decoding. Use it if available.
+try:
+    import pybase64 as base64
+except ModuleNotFoundError:
+    import base64
+
+# python-isal's isal_zlib is a drop-in replacement for zlib backed by Intel's ISA-L,
+# which compresses and decompresses several times faster. Use it if available. Note
+# that its default compression level is ISA-L's 2 (of 0 to 3), not zlib's 6, so files
+# written with it are somewhat larger. They remain plain zlib streams.
+try:
+    from isal import isal_zlib as zlib
+except ModuleNotFoundError:
+    import zlib
+
 # Paraview 5.8.1's built-in Python doesn't have lzma.
 try:
     import lzma
@@ -50,34 +69,63 @@ def _polyhedron_cells_from_data(offsets, faces, faceoffsets, cell_data_raw):
 
     # The faceoffsets describes the end of the face description for each
     # cell. Switch faceoffsets to give start points, not end points
-    faceoffsets = np.append([0], faceoffsets[:-1])
-
-    # Double loop over cells then faces.
-    # This will be slow, but seems necessary to cover all cases
-    for cell_start in faceoffsets:
-        num_faces_this_cell = faces[cell_start]
-        faces_this_cell = []
-        next_face = cell_start + 1
-        for _ in range(num_faces_this_cell):
-            num_nodes_this_face = faces[next_face]
-            faces_this_cell.append(
-                np.array(
-                    faces[next_face + 1 : (next_face + num_nodes_this_face + 1)],
-                    dtype=int,
-                )
-            )
-            # Increase by number of nodes just read, plus the item giving
-            # number of nodes per face
-            next_face += num_nodes_this_face + 1
-
-        # Done with this cell
-        # Find number of nodes for this cell
-        num_nodes_this_cell = np.unique(np.hstack([v for v in faces_this_cell])).size
+    face_ends = faceoffsets
+    faceoffsets = np.empty_like(face_ends)
+    faceoffsets[:1] = 0
+    faceoffsets[1:] = face_ends[:-1]
+
+    # The faces of the cells will be views into this array. Copy it once to get a typed,
+    # writable array that doesn't point into the file data.
+    faces = faces.astype(offsets.dtype)
+    num_faces = faces[faceoffsets]
+
+    # Index of the first face of each cell in the list of all faces
+    first_face = np.zeros(len(num_faces), dtype=int)
+    np.cumsum(num_faces[:-1], out=first_face[1:])
+
+    # Find the position of the num_nodes item of all faces. The position of a face
+    # depends on the size of the previous face in the same cell, so walk through the
+    # faces of all cells simultaneously: In step k, handle the k-th face of all cells
+    # that have more than k faces.
+    face_starts = np.empty(np.sum(num_faces), dtype=int)
+    cell_idx = np.arange(len(num_faces))
+    next_face = faceoffsets + 1
+    k = 0
+    while len(cell_idx) > 0:
+        is_active = num_faces[cell_idx] > k
+        cell_idx = cell_idx[is_active]
+        next_face = next_face[is_active]
+        face_starts[first_face[cell_idx] + k] = next_face
+        # Increase by number of nodes just read, plus the item giving number of nodes
+        # per face
+        next_face = next_face + faces[next_face] + 1
+        k += 1
 
+    # Views of the nodes of all faces, without the num_nodes items in between
+    num_nodes_per_face = faces[face_starts]
+    node_starts = face_starts + 1
+    node_ends = node_starts + num_nodes_per_face
+    all_faces = [
+        faces[start:end] for start, end in zip(node_starts.tolist(), node_ends.tolist())
+    ]
+
+    # Find number of nodes for all cells: Tag each node with the cell it belongs to,
+    # remove duplicate (cell, node) pairs and count the remaining ones per cell.
+    num_cells = len(num_faces)
+    cell_of_node = np.repeat(
+        np.repeat(np.arange(num_cells), num_faces), num_nodes_per_face
+    )
+    nodes = np.concatenate(all_faces) if all_faces else np.empty(0, dtype=int)
+    order = np.lexsort((nodes, cell_of_node))
+    cell_of_node = cell_of_node[order]
+    nodes = nodes[order]
+    is_first = np.ones(len(nodes), dtype=bool)
+    is_first[1:] = (cell_of_node[1:] != cell_of_node[:-1]) | (nodes[1:] != nodes[:-1])
+    num_nodes_per_cell = np.bincount(cell_of_node[is_first], minlength=num_cells)
+
+    for start, n, num_nodes_this_cell in zip(first_face, num_faces, num_nodes_per_cell):
         key = f"polyhedron{num_nodes_this_cell}"
-        if key not in cells.keys():
-            cells[key] = []
-        cells[key].append(faces_this_cell)
+        cells.setdefault(key, []).append(all_faces[start : start + n])
 
     # The cells will be assigned to blocks according to their number of nodes.
     # This is potentially a reordering, compared to the ordering in faces.
@@ -152,11 +200,21 @@ def _organize_cells(point_offsets, cells, cell_data_raw):
             )
 
         for c in cls:
-            out_cells.append(CellBlock(c.type, c.data + offset))
+            # Don't copy the data if there's nothing to add
+            out_cells.append(CellBlock(c.type, c.data + offset if offset else c.data))
 
     return out_cells, cell_data
 
 
+def _merge_pieces(arrays):
+    # Concatenating copies the data. Skip that for a single piece (the most common
+    # case), unless the array is read-only, e.g., because it points into the decoded
+    # file data.
+    if len(arrays) == 1 and arrays[0].flags.writeable:
+        return arrays[0]
+    return np.concatenate(arrays)
+
+
 def get_grid(root):
     grid = None
     appended_data = None
@@ -183,7 +241,48 @@ def get_grid(root):
     return grid, appended_data
 
 
+def _decompress_blocks(c, header, compressed):
+    # Decompress the blocks of a compressed data array. The header is
+    #   num_blocks, max_uncompressed_block_size, last_uncompressed_block_size,
+    #   compressed_block_size_0, compressed_block_size_1, ...
+    # The total uncompressed size is known in advance, so decompress the blocks straight
+    # into a preallocated byte array.
+    num_blocks = int(header[0])
+    max_uncompressed_block_size = int(header[1])
+    # The last block is full if its size is given as 0.
+    last_uncompressed_block_size = int(header[2]) or max_uncompressed_block_size
+    block_sizes = header[3:]
+
+    byte_offsets = np.empty(block_sizes.shape[0] + 1, dtype=block_sizes.dtype)
+    byte_offsets[0] = 0
+    np.cumsum(block_sizes, out=byte_offsets[1:])
+
+    num_bytes = (
+        (num_blocks - 1) * max_uncompressed_block_size + last_uncompressed_block_size
+        if num_blocks > 0
+        else 0
+    )
+    out = np.empty(num_bytes, dtype=np.uint8)
+    compressed = memoryview(compressed)
+    pos = 0
+    for k in range(num_blocks):
+        block = c.decompress(compressed[byte_offsets[k] : byte_offsets[k + 1]])
+        if pos + len(block) > num_bytes:
+            raise ReadError("Uncompressed data exceeds size given in header.")
+        out[pos : pos + len(block)] = np.frombuffer(block, dtype=np.uint8)
+        pos += len(block)
+
+    if pos != num_bytes:
+        raise ReadError("Uncompressed data is smaller than given in header.")
+
+    return out
+
+
 def _parse_raw_binary(filename):
+    # Raw binary appended data isn't valid XML, so parse the XML around it separately
+    # and split the data into its arrays directly. Returns the XML root (without the
+    # AppendedData tag) and a dictionary mapping the offsets of the arrays to their
+    # (decompressed) data.
     from xml.etree import ElementTree as ET
 
     with open(filename, "rb") as f:
@@ -199,7 +298,14 @@ def _parse_raw_binary(filename):
 
     header = raw[:i_start].decode()
     footer = raw[i_stop:].decode()
-    data = raw[i_start:i_stop].split(b"_", 1)[1].rsplit(b"\n", 1)[0]
+
+    # The appended data always begins with a (meaningless) underscore. Use a view to
+    # not copy the data. Whatever follows the last array, e.g., a line break ("\r\n" on
+    # Windows), is ignored below.
+    data_start = raw.find(b"_", i_start, i_stop)
+    if data_start == -1:
+        raise ReadError()
+    data = memoryview(raw)[data_start + 1 : i_stop]
 
     root = ET.fromstring(header + footer)
 
@@ -211,63 +317,54 @@ def _parse_raw_binary(filename):
 
     appended_data_tag = root.find("AppendedData")
     assert appended_data_tag is not None
-    appended_data_tag.set("encoding", "base64")
+    root.remove(appended_data_tag)
+
+    # Collect the offsets of all data arrays in one pass; searching the tree for every
+    # offset is quadratic in the number of data arrays. Converting the offsets to int
+    # also handles offsets padded with spaces, see
+    # <https://github.com/nschloe/meshio/issues/1135>.
+    offsets = {
+        int(da_tag.get("offset"))
+        for da_tag in root.iter("DataArray")
+        if da_tag.get("offset") is not None
+    }
+
+    arrays = {}
 
     compressor = root.get("compressor")
     if compressor is None:
-        arrays = ""
         i = 0
-        while i < len(data):
-            # The following find() runs into issues if offset is padded with spaces, see
-            # <https://github.com/nschloe/meshio/issues/1135>. It works in ParaView.
-            # Unfortunately, Python's built-in XML tree can't handle regexes, see
-            # <https://stackoverflow.com/a/38810731/353337>.
-            da_tag = root.find(f".//DataArray[@offset='{i}']")
-            if da_tag is None:
-                raise RuntimeError(f"Could not find .//DataArray[@offset='{i}']")
-            da_tag.set("offset", str(len(arrays)))
+        while i < len(data) and len(arrays) < len(offsets):
+            if i not in offsets:
+                raise RuntimeError(f"Could not find DataArray with offset {i}")
 
             block_size = int(np.frombuffer(data[i : i + dtype.itemsize], dtype)[0])
-            arrays += base64.b64encode(
-                data[i : i + block_size + dtype.itemsize]
-            ).decode()
+            arrays[i] = data[i + dtype.itemsize : i + dtype.itemsize + block_size]
             i += block_size + dtype.itemsize
 
     else:
         c = {"vtkLZMADataCompressor": lzma, "vtkZLibDataCompressor": zlib}[compressor]
         root.attrib.pop("compressor")
 
-        # raise ReadError("Compressed raw binary VTU files not supported.")
-        arrays = ""
         i = 0
-        while i < len(data):
-            da_tag = root.find(f".//DataArray[@offset='{i}']")
-            assert da_tag is not None
-            da_tag.set("offset", str(len(arrays)))
+        while i < len(data) and len(arrays) < len(offsets):
+            if i not in offsets:
+                raise RuntimeError(f"Could not find DataArray with offset {i}")
 
             num_blocks = int(np.frombuffer(data[i : i + dtype.itemsize], dtype)[0])
             num_header_items = 3 + num_blocks
             num_header_bytes = num_header_items * dtype.itemsize
             header = np.frombuffer(data[i : i + num_header_bytes], dtype)
 
-            block_data = b""
-            j = 0
-            for k in range(num_blocks):
-                block_size = int(header[k + 3])
-                block_data += c.decompress(
-                    data[
-                        i + j + num_header_bytes : i + j + block_size + num_header_bytes
-                    ]
-                )
-                j += block_size
-
-            block_size = np.array([len(block_data)]).astype(dtype).tobytes()
-            arrays += base64.b64encode(block_size + block_data).decode()
+            num_compressed_bytes = int(np.sum(header[3:]))
+            start = i + num_header_bytes
+            arrays[i] = _decompress_blocks(
+                c, header, data[start : start + num_compressed_bytes]
+            )
 
-            i += j + num_header_bytes
+            i += num_header_bytes + num_compressed_bytes
 
-    appended_data_tag.text = "_" + arrays
-    return root
+    return root, arrays
 
 
 vtu_to_numpy_type = {
@@ -292,14 +389,31 @@ class VtuReader:
     """
 
     def __init__(self, filename):  # noqa: C901
-        from xml.etree import ElementTree as ET
+        # Building the tree with lxml is faster than with the standard library. Use it
+        # if available. huge_tree is needed for large data arrays.
+        try:
+            from lxml import etree as ET
+
+            # huge_tree lifts lxml's security limits; never load external entities (XXE)
+            parser = ET.XMLParser(
+                remove_comments=True,
+                huge_tree=True,
+                resolve_entities=False,
+                no_network=True,
+            )
+        except ModuleNotFoundError:
+            from xml.etree import ElementTree as ET
+
+            parser = ET.XMLParser()
+
+        # Arrays from raw binary appended data, keyed by their offset
+        self.raw_arrays = None
 
-        parser = ET.XMLParser()
         try:
             tree = ET.parse(str(filename), parser)
             root = tree.getroot()
         except ET.ParseError:
-            root = _parse_raw_binary(str(filename))
+            root, self.raw_arrays = _parse_raw_binary(str(filename))
 
         if root.tag != "VTKFile":
             raise ReadError(f"Expected tag 'VTKFile', found {root.tag}")
@@ -423,16 +537,20 @@ class VtuReader:
         if len(cell_data_raw) != len(cells):
             raise ReadError()
 
-        point_offsets = np.cumsum([0] + [pts.shape[0] for pts in points][:-1])
+        if len(points) == 1:
+            # single piece, the most common case
+            point_offsets = [0]
+        else:
+            point_offsets = np.cumsum([0] + [pts.shape[0] for pts in points][:-1])
 
         # Now merge across pieces
         if not points:
             raise ReadError()
-        self.points = np.concatenate(points)
+        self.points = _merge_pieces(points)
 
         if point_data:
             self.point_data = {
-                key: np.concatenate([pd[key] for pd in point_data])
+                key: _merge_pieces([pd[key] for pd in point_data])
                 for key in point_data[0]
             }
         else:
@@ -444,8 +562,6 @@ class VtuReader:
         self.field_data = field_data
 
     def read_uncompressed_binary(self, data, dtype):
-        byte_string = base64.b64decode(data)
-
         # the first item is the total_num_bytes, given in header_dtype
         header_dtype = vtu_to_numpy_type[self.header_type]
         if self.byte_order is not None:
@@ -453,22 +569,51 @@ class VtuReader:
                 "<" if self.byte_order == "LittleEndian" else ">"
             )
         num_header_bytes = np.dtype(header_dtype).itemsize
-        total_num_bytes = np.frombuffer(byte_string[:num_header_bytes], header_dtype)[0]
+        num_header_chars = num_bytes_to_num_base64_chars(num_header_bytes)
+        byte_string = base64.b64decode(data[:num_header_chars])
+        total_num_bytes = int(
+            np.frombuffer(byte_string[:num_header_bytes], header_dtype)[0]
+        )
 
-        # Check if block size was decoded separately
-        # (so decoding stopped after block size due to padding)
-        if len(byte_string) == num_header_bytes:
-            header_len = len(base64.b64encode(byte_string))
-            byte_string = base64.b64decode(data[header_len:])
+        # Only decode the characters belonging to this array; `data` may hold more
+        # arrays after it. The block size is either encoded together with the data or
+        # separately, in which case its encoding is padded. Check the full padding;
+        # the joint encoding of the header and a single byte ends in "=", too.
+        num_padding = -num_header_bytes % 3
+        start = num_header_chars - num_padding
+        if data[start:num_header_chars] == "=" * num_padding:
+            num_chars = num_bytes_to_num_base64_chars(total_num_bytes)
+            byte_string = base64.b64decode(
+                data[num_header_chars : num_header_chars + num_chars]
+            )
+            data_offset = 0
         else:
-            byte_string = byte_string[num_header_bytes:]
+            # Decode header and data in one go, the header is skipped below.
+            num_chars = num_bytes_to_num_base64_chars(
+                num_header_bytes + total_num_bytes
+            )
+            byte_string = base64.b64decode(data[:num_chars])
+            data_offset = num_header_bytes
 
         # Read the block data; multiple blocks possible here?
         if self.byte_order is not None:
             dtype = dtype.newbyteorder(
                 "<" if self.byte_order == "LittleEndian" else ">"
             )
-        return np.frombuffer(byte_string[:total_num_bytes], dtype=dtype)
+        if total_num_bytes % dtype.itemsize != 0:
+            raise ReadError(
+                f"Data size {total_num_bytes} given in header "
+                f"is not a multiple of the item size {dtype.itemsize}."
+            )
+        if len(byte_string) - data_offset < total_num_bytes:
+            raise ReadError("Data is smaller than given in header.")
+        # Point into the decoded bytes instead of slicing (and thereby copying) them
+        return np.frombuffer(
+            byte_string,
+            dtype=dtype,
+            count=total_num_bytes // dtype.itemsize,
+            offset=data_offset,
+        )
 
     def read_compressed_binary(self, data, dtype):
         # first read the block size; it determines the size of the header
@@ -489,39 +634,28 @@ class VtuReader:
         byte_string = base64.b64decode(data[:num_header_chars])
         header = np.frombuffer(byte_string, header_dtype)
 
-        # num_blocks = header[0]
-        # max_uncompressed_block_size = header[1]
-        # last_compressed_block_size = header[2]
-        block_sizes = header[3:]
-
         # Read the block data
-        byte_array = base64.b64decode(data[num_header_chars:])
+        num_chars = num_bytes_to_num_base64_chars(int(np.sum(header[3:])))
+        byte_array = base64.b64decode(
+            data[num_header_chars : num_header_chars + num_chars]
+        )
         if self.byte_order is not None:
             dtype = dtype.newbyteorder(
                 "<" if self.byte_order == "LittleEndian" else ">"
             )
 
-        byte_offsets = np.empty(block_sizes.shape[0] + 1, dtype=block_sizes.dtype)
-        byte_offsets[0] = 0
-        np.cumsum(block_sizes, out=byte_offsets[1:])
-
         assert self.compression is not None
         c = {"vtkLZMADataCompressor": lzma, "vtkZLibDataCompressor": zlib}[
             self.compression
         ]
 
-        # process the compressed data
-        block_data = np.concatenate(
-            [
-                np.frombuffer(
-                    c.decompress(byte_array[byte_offsets[k] : byte_offsets[k + 1]]),
-                    dtype=dtype,
-                )
-                for k in range(num_blocks)
-            ]
-        )
-
-        return block_data
+        block_data = _decompress_blocks(c, header, byte_array)
+        if block_data.size % dtype.itemsize != 0:
+            raise ReadError(
+                f"Uncompressed size {block_data.size} "
+                "is not a multiple of the item size."
+            )
+        return block_data.view(dtype)
 
     def read_data(self, c):
         fmt = c.attrib["format"] if "format" in c.attrib else "ascii"
@@ -534,10 +668,14 @@ class VtuReader:
 
         if fmt == "ascii":
             # ascii
-            if c.text.strip() == "":
+            # Don't strip() the text for the check; it may be huge. isspace() returns
+            # at the first non-whitespace character.
+            if not c.text or c.text.isspace():
                 # https://github.com/numpy/numpy/issues/18435
                 data = np.empty((0,), dtype=dtype)
             else:
+                # fromstring's text mode is a C parser and, contrary to its binary
+                # mode, not deprecated. It outperforms split()/loadtxt() by far.
                 data = np.fromstring(c.text, dtype=dtype, sep=" ")
         elif fmt == "binary":
             reader = (
@@ -545,7 +683,31 @@ class VtuReader:
                 if self.compression is None
                 else self.read_compressed_binary
             )
-            data = reader(c.text.strip(), dtype)
+            # The text holds exactly this array. Remove all whitespace, including line
+            # breaks some writers put into the base64 text, before the readers count
+            # characters.
+            data = reader("".join(c.text.split()), dtype)
+        elif fmt == "appended" and self.raw_arrays is not None:
+            # The raw data has already been split up (and decompressed) by
+            # _parse_raw_binary().
+            offset = int(c.attrib["offset"])
+            if offset not in self.raw_arrays:
+                raise ReadError(f"No appended data found at offset {offset}.")
+            if self.byte_order is not None:
+                dtype = dtype.newbyteorder(
+                    "<" if self.byte_order == "LittleEndian" else ">"
+                )
+            raw = self.raw_arrays[offset]
+            if len(raw) % dtype.itemsize != 0:
+                raise ReadError(
+                    f"Appended data at offset {offset} has {len(raw)} bytes, "
+                    f"which isn't a multiple of the item size {dtype.itemsize}."
+                )
+            data = np.frombuffer(raw, dtype=dtype)
+            if not data.flags.writeable:
+                # Uncompressed arrays point into the data of the entire file. Copy
+                # them so that they don't keep all of it alive.
+                data = data.copy()
         elif fmt == "appended":
             offset = int(c.attrib["offset"])
             reader = (
@@ -583,6 +745,15 @@ def read(filename):
     )
 
 
+def _to_native(array):
+    # Most data already comes in the native byte order, so only convert if
+    # necessary. Don't use byteswap to make sure that the dtype is changed; see
+    # <https://github.com/numpy/numpy/issues/10372>.
+    if array.dtype.isnative:
+        return array
+    return array.astype(array.dtype.newbyteorder("="))
+
+
 def _chunk_it(array, n):
     k = 0
     while k * n < len(array):
@@ -590,7 +761,101 @@ def _chunk_it(array, n):
         k += 1
 
 
-def write(filename, mesh, binary=True, compression="zlib", header_type=None):
+def _write_base64(f, data, chunk_size=3 * 2**20):
+    # Encode and write the data piece by piece instead of creating the encoded
+    # string of the entire (potentially large) array in memory. Since the chunk size is
+    # a multiple of 3 bytes, no padding is inserted between the pieces, so the result
+    # is the same as encoding everything at once.
+    for chunk in _chunk_it(memoryview(data), chunk_size):
+        f.write(base64.b64encode(chunk).decode())
+
+
+@lru_cache(maxsize=None)
+def _thread_pool(max_workers):
+    # Shared between all writes; the threads are only started when needed.
+    return ThreadPoolExecutor(max_workers)
+
+
+# A forked child doesn't inherit the worker threads, but the pools would still believe
+# they have idle workers and never start new ones. Give the child fresh pools.
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_thread_pool.cache_clear)
+
+
+def _compress_executor(compression):
+    # Every concurrent lzma compressor allocates about 100 MiB of encoder state, so
+    # use fewer threads for it.
+    max_workers = min(os.cpu_count() or 1, 2 if compression == "lzma" else 8)
+    return _thread_pool(max_workers)
+
+
+def _compress(data_bytes, compression, header_type):
+    max_block_size = 32768
+
+    # round up
+    num_blocks = -int(-len(data_bytes) // max_block_size)
+    last_block_size = len(data_bytes) - (num_blocks - 1) * max_block_size
+
+    # It's too bad that we have to keep all blocks in memory. This is necessary
+    # because the header, written first, needs to know the lengths of all blocks.
+    # Also, the blocks are encoded _after_ having been concatenated. Append the blocks
+    # to one buffer as they come in rather than joining them in the end, which needs
+    # twice the memory.
+    c = {"lzma": lzma, "zlib": zlib}[compression]
+    compressed_data = bytearray()
+    compressed_block_sizes = []
+    # This compress is the slowest part of the writer. The blocks are independent and
+    # both zlib and lzma release the GIL while compressing, so compress them in
+    # parallel. map() preserves the order.
+    mapper = _compress_executor(compression).map if num_blocks > 1 else map
+    for block in mapper(c.compress, _chunk_it(data_bytes, max_block_size)):
+        compressed_block_sizes.append(len(block))
+        compressed_data += block
+
+    # collect header
+    header = np.array(
+        [num_blocks, max_block_size, last_block_size] + compressed_block_sizes,
+        dtype=vtu_to_numpy_type[header_type],
+    )
+    return header, compressed_data
+
+
+def _write_binary(f, data_bytes, compression, header_type):
+    if compression:
+        header, compressed_data = _compress(data_bytes, compression, header_type)
+        # The header must be encoded separately; VTK expects it that way.
+        f.write(base64.b64encode(header.tobytes()).decode())
+        _write_base64(f, compressed_data)
+        return
+
+    # collect header
+    header = np.array(len(data_bytes), dtype=vtu_to_numpy_type[header_type])
+    # The header is encoded jointly with the data. Encode it together with the first
+    # few data bytes such that the rest starts at a multiple of 3 bytes and can be
+    # written in chunks.
+    k = -header.nbytes % 3
+    f.write(base64.b64encode(header.tobytes() + data_bytes[:k].tobytes()).decode())
+    _write_base64(f, data_bytes[k:])
+
+
+@lru_cache(maxsize=128)
+def _encode_small(data_bytes, compression, header_type):
+    f = io.StringIO()
+    _write_binary(
+        f, np.frombuffer(data_bytes, dtype=np.uint8), compression, header_type
+    )
+    return f.getvalue()
+
+
+def _index_dtype(*bounds):
+    # VTK reads Int32 connectivity, offsets, and faces just as well as Int64. Use Int32
+    # when all values fit; it halves the size of the arrays.
+    return np.int32 if max(bounds) < 2**31 else np.int64
+
+
+def write(
+    filename, mesh, binary=True, compression="zlib", header_type=None, appended=False
+):
     # Writing XML with an etree required first transforming the (potentially large)
     # arrays into string, which are much larger in memory still. This makes this writer
     # very memory hungry. See <https://stackoverflow.com/q/59272477/353337>.
@@ -608,7 +873,7 @@ def write(filename, mesh, binary=True, compression="zlib", header_type=None):
     # To write such meshes, represent all cells as polyhedra.
     if is_polyhedron_grid:
         for c in mesh.cells:
-            if c.type[:10] != "polyhedron":
+            if not c.type.startswith("polyhedron"):
                 raise ValueError(
                     "VTU export cannot mix polyhedral cells with other cell types"
                 )
@@ -668,93 +933,91 @@ def write(filename, mesh, binary=True, compression="zlib", header_type=None):
         vtk_file.set("compressor", compressions[compression])
 
     # swap the data to match the system byteorder
-    # Don't use byteswap to make sure that the dtype is changed; see
-    # <https://github.com/numpy/numpy/issues/10372>.
-    points = points.astype(points.dtype.newbyteorder("="), copy=False)
+    points = _to_native(points)
     for k, cell_block in enumerate(mesh.cells):
         cell_type = cell_block.type
         data = cell_block.data
         # Treatment of polyhedra is different from other types
         if is_polyhedron_grid:
-            new_cell_info = []
-            for cell_info in data:
-                new_face_info = []
-                for face_info in cell_info:
-                    face_info = np.asarray(face_info)
-                    new_face_info.append(
-                        face_info.astype(face_info.dtype.newbyteorder("="), copy=False)
-                    )
-                new_cell_info.append(new_face_info)
+            new_cell_info = [
+                [_to_native(np.asarray(face_info)) for face_info in cell_info]
+                for cell_info in data
+            ]
             mesh.cells[k] = CellBlock(cell_type, new_cell_info)
-        else:
-            mesh.cells[k] = CellBlock(
-                cell_type, data.astype(data.dtype.newbyteorder("="), copy=False)
-            )
+        elif not data.dtype.isnative:
+            mesh.cells[k] = CellBlock(cell_type, _to_native(data))
     for key, data in mesh.point_data.items():
-        mesh.point_data[key] = data.astype(data.dtype.newbyteorder("="), copy=False)
+        mesh.point_data[key] = _to_native(data)
 
     for data in mesh.cell_data.values():
         for k, dat in enumerate(data):
-            data[k] = dat.astype(dat.dtype.newbyteorder("="), copy=False)
+            data[k] = _to_native(dat)
     for key, data in mesh.field_data.items():
-        mesh.field_data[key] = data.astype(data.dtype.newbyteorder("="), copy=False)
+        mesh.field_data[key] = _to_native(data)
+
+    # With appended=True, the binary data of all arrays goes, unencoded, into one
+    # AppendedData section at the end of the file. The DataArrays only refer to their
+    # offset in it.
+    appended_data = []
+    appended_data_size = 0
 
     def numpy_to_xml_array(parent, name, data):
+        nonlocal appended_data_size
+
         vtu_type = numpy_to_vtu_type[data.dtype]
-        fmt = "{:.11e}" if vtu_type.startswith("Float") else "{:d}"
+        fmt = "%.11e" if vtu_type.startswith("Float") else "%d"
         da = ET.SubElement(parent, "DataArray", type=vtu_type, Name=name)
         if len(data.shape) == 2:
             da.set("NumberOfComponents", f"{data.shape[1]}")
 
-        def text_writer_compressed(f):
-            max_block_size = 32768
-            data_bytes = data.tobytes()
-
-            # round up
-            num_blocks = -int(-len(data_bytes) // max_block_size)
-            last_block_size = len(data_bytes) - (num_blocks - 1) * max_block_size
-
-            # It's too bad that we have to keep all blocks in memory. This is
-            # necessary because the header, written first, needs to know the
-            # lengths of all blocks. Also, the blocks are encoded _after_ having
-            # been concatenated.
-            c = {"lzma": lzma, "zlib": zlib}[compression]
-            compressed_blocks = [
-                # This compress is the slowest part of the writer
-                c.compress(block)
-                for block in _chunk_it(data_bytes, max_block_size)
-            ]
-
-            # collect header
-            header = np.array(
-                [num_blocks, max_block_size, last_block_size]
-                + [len(b) for b in compressed_blocks],
-                dtype=vtu_to_numpy_type[header_type],
-            )
-            f.write(base64.b64encode(header.tobytes()).decode())
-            f.write(base64.b64encode(b"".join(compressed_blocks)).decode())
-
-        def text_writer_uncompressed(f):
-            data_bytes = data.tobytes()
-            # collect header
-            header = np.array(len(data_bytes), dtype=vtu_to_numpy_type[header_type])
-            f.write(base64.b64encode(header.tobytes() + data_bytes).decode())
+        # A flat byte view of the data; unlike tobytes(), this doesn't copy the data
+        # if it is contiguous already.
+        def data_as_bytes():
+            return np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+
+        def text_writer_binary(f):
+            data_bytes = data_as_bytes()
+            if len(data_bytes) <= 4096:
+                # Small arrays, e.g., cell data of few cells or the offsets and types
+                # of a mesh written over and over in a time series, are often the same
+                # from one DataArray or file to the next. Reuse their encoding.
+                f.write(_encode_small(data_bytes.tobytes(), compression, header_type))
+            else:
+                _write_binary(f, data_bytes, compression, header_type)
 
         def text_writer_ascii(f):
-            # This write() loop is the bottleneck for the write. Alternatives:
+            # Formatting the items is the bottleneck for the write. Alternatives:
             # savetxt is super slow:
             #   np.savetxt(f, data.reshape(-1), fmt=fmt)
-            # joining and writing is a bit faster, but consumes huge amounts of
-            # memory:
-            #   f.write("\n".join(map(fmt.format, data.reshape(-1))))
-            for item in data.reshape(-1):
-                f.write((fmt + "\n").format(item))
-
-        if binary:
+            # np.char.mod() is no faster than format(), and formatting everything at
+            # once consumes huge amounts of memory:
+            #   f.write("\n".join(map("{:.11e}".format, data.reshape(-1))))
+            # Format and write in chunks instead. Formatting Python scalars from
+            # tolist() is cheaper than formatting NumPy scalars, and a single printf-style
+            # format of the whole chunk is two to three times faster than formatting the
+            # items one by one.
+            for chunk in _chunk_it(data.reshape(-1), 100_000):
+                items = tuple(chunk.tolist())
+                f.write((fmt + "\n") * len(items) % items)
+
+        if binary and appended:
+            da.set("format", "appended")
+            da.set("offset", f"{appended_data_size}")
+            # The offsets of the following arrays depend on the compressed size, so
+            # the data has to be compressed right away.
+            if compression:
+                header, payload = _compress(data_as_bytes(), compression, header_type)
+                num_header_bytes = header.nbytes
+            else:
+                # The header is only the size of the data, filled in when writing
+                header = None
+                payload = data_as_bytes()
+                num_header_bytes = vtu_to_numpy_type[header_type].itemsize
+            appended_data.append((header, payload))
+            appended_data_size += num_header_bytes + len(payload)
+        elif binary:
             da.set("format", "binary")
-            da.text_writer = (
-                text_writer_compressed if compression else text_writer_uncompressed
-            )
+            da.text_writer = text_writer_binary
         else:
             da.set("format", "ascii")
             da.text_writer = text_writer_ascii
@@ -767,25 +1030,61 @@ def write(filename, mesh, binary=True, compression="zlib", header_type=None):
         #
         # The output format is specified at https://vtk.org/Wiki/VTK/Polyhedron_Support
 
-        # Initialize array for size of data per cell.
-        data_size_per_cell = np.zeros(len(face_cells), dtype=int)
-
-        # The data itself is of unknown size, and cannot be initialized
-        data = []
-        for ci, cell in enumerate(face_cells):
-            # Number of faces for this cell
-            data.append(len(cell))
-            for face in cell:
-                # Number of nodes for this face
-                data.append(face.size)
-                # The nodes themselves
-                data += face.tolist()
-
-            data_size_per_cell[ci] = len(data)
+        # Flatten the cell-face-node nesting into the nodes of all faces, the number of
+        # nodes per face, and the number of faces per cell. The rest is done on those
+        # arrays without a Python loop over the faces.
+        num_cells = len(face_cells)
+        faces_per_cell = np.fromiter(
+            (len(cell) for cell in face_cells), dtype=np.int64, count=num_cells
+        )
+        all_faces = [face for cell in face_cells for face in cell]
+        face_sizes = np.fromiter(
+            (face.size for face in all_faces), dtype=np.int64, count=len(all_faces)
+        )
+        nodes = np.concatenate(all_faces) if all_faces else np.empty(0, dtype=np.int64)
+
+        # The data is, for every cell, the number of faces followed by the faces, each
+        # given by its number of nodes and the nodes themselves. items_before[i] is the
+        # number of face items before face i, not counting the cell items.
+        items_before = np.zeros(len(face_sizes) + 1, dtype=np.int64)
+        np.cumsum(face_sizes + 1, out=items_before[1:])
+        # The end of each cell in the data is the cumulative sum of the number of
+        # items per cell, which is known from the input alone.
+        first_face = np.cumsum(faces_per_cell) - faces_per_cell
+        items_per_cell = 1 + (
+            items_before[first_face + faces_per_cell] - items_before[first_face]
+        )
+        data_size_per_cell = np.cumsum(items_per_cell)
+        cell_pos = data_size_per_cell - items_per_cell
+        cell_idx = np.arange(num_cells)
+        face_pos = items_before[:-1] + np.repeat(cell_idx, faces_per_cell) + 1
+
+        data = np.empty(num_cells + len(face_sizes) + len(nodes), dtype=np.int64)
+        data[cell_pos] = faces_per_cell
+        data[face_pos] = face_sizes
+        is_node = np.ones(len(data), dtype=bool)
+        is_node[cell_pos] = False
+        is_node[face_pos] = False
+        data[is_node] = nodes
+
+        # The cell-node relation is the sorted unique nodes of the faces of each cell.
+        # Sort the nodes within each cell (the cells already are in order) and drop
+        # the duplicates.
+        cell_of_node = np.repeat(np.repeat(cell_idx, faces_per_cell), face_sizes)
+        order = np.lexsort((nodes, cell_of_node))
+        cell_of_node = cell_of_node[order]
+        nodes = nodes[order]
+        is_first = np.ones(len(nodes), dtype=bool)
+        is_first[1:] = (cell_of_node[1:] != cell_of_node[:-1]) | (
+            nodes[1:] != nodes[:-1]
+        )
+        cell_nodes = nodes[is_first]
+        num_nodes_per_cell = np.bincount(cell_of_node[is_first], minlength=num_cells)
 
         # The returned data corresponds to the faces and faceoffsets fields in the
-        # vtu polyhedron data format
-        return data, data_size_per_cell.tolist()
+        # vtu polyhedron data format, and the connectivity and number of nodes of the
+        # cells
+        return data, data_size_per_cell, cell_nodes, num_nodes_per_cell
 
     comment = ET.Comment(f"This file was created by meshio v{__version__}")
     vtk_file.insert(1, comment)
@@ -808,80 +1107,80 @@ def write(filename, mesh, binary=True, compression="zlib", header_type=None):
     if mesh.cells is not None and len(mesh.cells) > 0:
         cls = ET.SubElement(piece, "Cells")
 
-        faces = None
-        faceoffsets = None
-
+        # create connectivity, offset, type arrays in one pass over the cell blocks
         if is_polyhedron_grid:
-            # The VTK polyhedron format requires both Cell-node connectivity, and a
-            # definition of faces. The cell-node relation must be recoved from the
-            # cell-face-nodes currently in CellBlocks.
-            # NOTE: If polyhedral cells are implemented for more mesh types, this code
-            # block may be useful for those as well.
-            con = []
-            num_nodes_per_cell = []
-            for block in mesh.cells:
-                for cell in block.data:
-                    nodes_this_cell = []
-                    for face in cell:
-                        nodes_this_cell += face.tolist()
-                    unique_nodes = np.unique(nodes_this_cell).tolist()
-
-                    con += unique_nodes
-                    num_nodes_per_cell.append(len(unique_nodes))
-
-            connectivity = np.array(con)
-            # offsets = np.hstack(([0], np.cumsum(num_nodes_per_cell)[:-1]))
-            offsets = np.cumsum(num_nodes_per_cell)
-
-            # Initialize data structures for polyhedral cells
-            faces = []
-            faceoffsets = []
-
-        else:
-            # create connectivity, offset, type arrays
+            # The size is only known after the nodes of the faces have been collected.
             connectivity = []
-            for v in mesh.cells:
-                d = v.data
-                new_order = meshio_to_vtk_order(v.type)
-                if new_order is not None:
-                    d = d[:, new_order]
-                connectivity.append(d.flatten())
-            connectivity = np.concatenate(connectivity)
-
-            # offset (points to the first element of the next cell)
-            offsets = [
-                v.data.shape[1]
-                * np.arange(1, v.data.shape[0] + 1, dtype=connectivity.dtype)
-                for v in mesh.cells
-            ]
-            for k in range(1, len(offsets)):
-                offsets[k] += offsets[k - 1][-1]
-            offsets = np.concatenate(offsets)
-
-        # types
-        types_array = []
+        else:
+            # Copy the blocks right into place instead of concatenating them.
+            num_items = sum(c.data.size for c in mesh.cells)
+            connectivity = np.empty(
+                num_items, dtype=_index_dtype(len(points), num_items)
+            )
+        con_end = 0
+        num_nodes_per_cell = []
+        # VTK cell types fit in, and are conventionally stored as, UInt8
+        types = np.empty(total_num_cells, dtype=np.uint8)
+        types_end = 0
+        faces = []
+        faceoffsets = []
+        faceoffset_base = 0
+        # Look up the VTK type and node order once per cell type, not once per block.
+        # meshio_to_vtk_order() is None if the orders agree.
+        vtk_info = {
+            c.type: (
+                meshio_to_vtk_type[
+                    "polyhedron" if c.type.startswith("polyhedron") else c.type
+                ],
+                meshio_to_vtk_order(c.type),
+            )
+            for c in mesh.cells
+        }
         for cell_block in mesh.cells:
-            key = cell_block.type
+            vtk_type, new_order = vtk_info[cell_block.type]
             # some adaptions for polyhedron
-            if key.startswith("polyhedron"):
-                # Get face-cell relation on the vtu format. See comments in helper
-                # function for more information of how to specify this.
-                faces_loc, faceoffsets_loc = _polyhedron_face_cells(cell_block.data)
+            if is_polyhedron_grid:
+                # The VTK polyhedron format requires both Cell-node connectivity, and
+                # a definition of faces. The cell-node relation must be recoved from
+                # the cell-face-nodes currently in CellBlocks.
+                # NOTE: If polyhedral cells are implemented for more mesh types, this
+                # code block may be useful for those as well.
+                #
+                # Get face-cell and cell-node relations on the vtu format. See comments
+                # in helper function for more information of how to specify this.
+                (
+                    faces_loc,
+                    faceoffsets_loc,
+                    cell_nodes,
+                    num_nodes_loc,
+                ) = _polyhedron_face_cells(cell_block.data)
+                connectivity.append(cell_nodes)
+                num_nodes_per_cell.append(num_nodes_loc)
                 # Adjust offsets to global numbering
-                assert faceoffsets is not None
-                if len(faceoffsets) > 0:
-                    faceoffsets_loc = [fi + faceoffsets[-1] for fi in faceoffsets_loc]
+                faceoffsets_loc += faceoffset_base
 
-                assert faces is not None
-                faces += faces_loc
-                faceoffsets += faceoffsets_loc
-                key = "polyhedron"
+                faces.append(faces_loc)
+                faceoffsets.append(faceoffsets_loc)
+                if len(faceoffsets_loc) > 0:
+                    faceoffset_base = faceoffsets_loc[-1]
+            else:
+                d = cell_block.data
+                con = connectivity[con_end : con_end + d.size].reshape(d.shape)
+                con[...] = d if new_order is None else d[:, new_order]
+                con_end += d.size
+                num_nodes_per_cell.append(np.full(d.shape[0], d.shape[1]))
 
-            types_array.append(np.full(len(cell_block), meshio_to_vtk_type[key]))
+            types[types_end : types_end + len(cell_block)] = vtk_type
+            types_end += len(cell_block)
 
-        types = np.concatenate(
-            types_array
-            # [np.full(len(v), meshio_to_vtk_type[k]) for k, v in mesh.cells]
+        if is_polyhedron_grid:
+            connectivity = np.concatenate(connectivity)
+            connectivity = connectivity.astype(
+                _index_dtype(len(points), len(connectivity)), copy=False
+            )
+        # offset (points to the first element of the next cell)
+        offsets = np.cumsum(
+            np.concatenate(num_nodes_per_cell), dtype=connectivity.dtype
         )
 
         numpy_to_xml_array(cls, "connectivity", connectivity)
@@ -890,8 +1189,17 @@ def write(filename, mesh, binary=True, compression="zlib", header_type=None):
 
         if is_polyhedron_grid:
             # Also store face-node relation
-            numpy_to_xml_array(cls, "faces", np.array(faces, dtype=int))
-            numpy_to_xml_array(cls, "faceoffsets", np.array(faceoffsets, dtype=int))
+            # The arrays of a single block are used as they are, without a copy
+            faces = faces[0] if len(faces) == 1 else np.concatenate(faces)
+            faceoffsets = (
+                faceoffsets[0] if len(faceoffsets) == 1 else np.concatenate(faceoffsets)
+            )
+            # The face offsets, node counts and nodes are all bounded by these
+            dtype = _index_dtype(len(points), len(faces))
+            faces = faces.astype(dtype, copy=False)
+            faceoffsets = faceoffsets.astype(dtype, copy=False)
+            numpy_to_xml_array(cls, "faces", faces)
+            numpy_to_xml_array(cls, "faceoffsets", faceoffsets)
 
     if mesh.point_data:
         pd = ET.SubElement(piece, "PointData")
@@ -903,6 +1211,27 @@ def write(filename, mesh, binary=True, compression="zlib", header_type=None):
         for name, data in raw_from_cell_data(mesh.cell_data).items():
             numpy_to_xml_array(cd, name, data)
 
+    if appended_data:
+
+        def text_writer_appended(f):
+            # The data begins after an underscore. The file is opened in text mode, so
+            # write the raw bytes to the underlying binary buffer.
+            f.write("_")
+            f.flush()
+            # Pack the sizes of uncompressed arrays into one reused buffer
+            size_format = {"UInt32": "=I", "UInt64": "=Q"}[header_type]
+            size_buffer = bytearray(struct.calcsize(size_format))
+            for header, payload in appended_data:
+                if header is None:
+                    struct.pack_into(size_format, size_buffer, 0, len(payload))
+                    f.buffer.write(size_buffer)
+                else:
+                    f.buffer.write(header)
+                f.buffer.write(payload)
+
+        ad = ET.SubElement(vtk_file, "AppendedData", encoding="raw")
+        ad.text_writer = text_writer_appended
+
     # write_xml(filename, vtk_file, pretty_xml)
     tree = ET.ElementTree(vtk_file)
     tree.write(filename)
@@ -1,4 +1,7 @@
+import base64
+import multiprocessing
 import pathlib
+import textwrap
 
 import numpy as np
 import pytest
@@ -55,6 +58,203 @@ def test(mesh, data_type, tmp_path):
     helpers.write_read(tmp_path, writer, meshio.vtu.read, mesh, tol)
 
 
+@pytest.mark.parametrize("mesh", test_set)
+@pytest.mark.parametrize("compression", [None, "lzma", "zlib"])
+@pytest.mark.parametrize("header_type", [None, "UInt64"])
+def test_appended(mesh, compression, header_type, tmp_path):
+    def writer(*args, **kwargs):
+        return meshio.vtu.write(
+            *args,
+            compression=compression,
+            header_type=header_type,
+            appended=True,
+            **kwargs,
+        )
+
+    helpers.write_read(tmp_path, writer, meshio.vtu.read, mesh, 1.0e-15)
+
+    content = (tmp_path / "test.dat").read_bytes()
+    assert b'<AppendedData encoding="raw">' in content
+    assert b'format="appended"' in content
+    assert b'format="binary"' not in content
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_appended_crlf(compression, tmp_path):
+    # On Windows, the line break after the raw data is written as "\r\n"
+    mesh = helpers.add_cell_data(helpers.tri_mesh, [("a", (), np.float64)])
+    filename = tmp_path / "test.vtu"
+    meshio.vtu.write(filename, mesh, compression=compression, appended=True)
+    content = filename.read_bytes()
+    assert content.count(b"\n</AppendedData>") == 1
+    filename.write_bytes(content.replace(b"\n</AppendedData>", b"\r\n</AppendedData>"))
+
+    mesh2 = meshio.vtu.read(filename)
+    assert np.array_equal(mesh.points, mesh2.points)
+    assert np.array_equal(mesh.cell_data["a"][0], mesh2.cell_data["a"][0])
+
+
+def test_raw_arrays_are_copied(tmp_path):
+    # Arrays read from uncompressed raw appended data must not point into the data of
+    # the entire file
+    mesh = helpers.add_cell_data(helpers.tri_mesh, [("a", (), np.float64)])
+    filename = tmp_path / "test.vtu"
+    meshio.vtu.write(filename, mesh, compression=None, appended=True)
+
+    mesh2 = meshio.vtu.read(filename)
+    data = mesh2.cell_data["a"][0]
+    assert data.flags.writeable
+    assert not isinstance(data.base, memoryview)
+    assert np.array_equal(data, mesh.cell_data["a"][0])
+
+
+def test_isal_zlib(monkeypatch, tmp_path):
+    # Files compressed by python-isal must be readable with the standard zlib
+    isal_zlib = pytest.importorskip("isal.isal_zlib")
+    import zlib
+
+    from meshio.vtu import _vtu
+
+    assert _vtu.zlib is isal_zlib
+    mesh = helpers.add_point_data(helpers.tri_mesh, 3)
+    filename = tmp_path / "test.vtu"
+    meshio.vtu.write(filename, mesh, compression="zlib")
+
+    monkeypatch.setattr(_vtu, "zlib", zlib)
+    mesh2 = meshio.vtu.read(filename)
+    assert np.array_equal(mesh.points, mesh2.points)
+    assert np.array_equal(mesh.point_data["a"], mesh2.point_data["a"])
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+def test_write_compressed_after_fork(tmp_path):
+    # The compression thread pools must keep working in forked children, e.g., when
+    # writing time steps from a multiprocessing.Pool.
+    rng = np.random.default_rng(0)
+    mesh = meshio.Mesh(
+        rng.random((10_000, 3)), [("triangle", rng.integers(0, 10_000, (100, 3)))]
+    )
+    meshio.vtu.write(tmp_path / "parent.vtu", mesh, compression="zlib")
+
+    process = multiprocessing.get_context("fork").Process(
+        target=meshio.vtu.write,
+        args=(tmp_path / "child.vtu", mesh),
+        kwargs={"compression": "zlib"},
+    )
+    process.start()
+    process.join(60)
+    if process.is_alive():
+        process.kill()
+        pytest.fail("writing in the forked child hangs")
+    assert process.exitcode == 0
+
+    mesh2 = meshio.vtu.read(tmp_path / "child.vtu")
+    assert np.array_equal(mesh.points, mesh2.points)
+
+
+@pytest.mark.parametrize("compression", [None, "zlib", "lzma"])
+@pytest.mark.parametrize("appended", [False, True])
+def test_large(compression, appended, tmp_path):
+    # Arrays of several MiB span many compression blocks and base64 write chunks. The
+    # point data is a whole number of blocks.
+    rng = np.random.default_rng(0)
+    num_points = 40 * 32768 // 8
+    mesh = meshio.Mesh(
+        rng.random((num_points, 3)),
+        [("triangle", rng.integers(0, num_points, (1000, 3)))],
+        point_data={"a": rng.random(num_points)},
+    )
+
+    def writer(*args, **kwargs):
+        return meshio.vtu.write(
+            *args, compression=compression, appended=appended, **kwargs
+        )
+
+    helpers.write_read(tmp_path, writer, meshio.vtu.read, mesh, 0.0)
+
+
+def test_decompress_full_last_block():
+    # A last block size of 0 in the header means that the last block is full
+    import zlib
+
+    from meshio.vtu._vtu import _decompress_blocks
+
+    data = np.random.default_rng(0).integers(0, 256, 3 * 32768, dtype=np.uint8)
+    blocks = [
+        zlib.compress(data[k : k + 32768].tobytes()) for k in range(0, 98304, 32768)
+    ]
+    header = np.array([3, 32768, 0] + [len(block) for block in blocks], dtype=np.uint32)
+    out = _decompress_blocks(zlib, header, b"".join(blocks))
+    assert np.array_equal(out, data)
+
+
+def test_no_external_entities(tmp_path):
+    pytest.importorskip("lxml")
+    secret = tmp_path / "secret.txt"
+    secret.write_text("7")
+    filename = tmp_path / "test.vtu"
+    filename.write_text(
+        textwrap.dedent(
+            f"""\
+            <?xml version="1.0"?>
+            <!DOCTYPE VTKFile [<!ENTITY xxe SYSTEM "{secret.as_uri()}">]>
+            <VTKFile type="UnstructuredGrid" version="0.1">
+            <UnstructuredGrid>
+            <Piece NumberOfPoints="2" NumberOfCells="1">
+            <Points>
+            <DataArray type="Float64" NumberOfComponents="3" format="ascii">
+            0 0 0 1 1 1
+            </DataArray>
+            </Points>
+            <PointData>
+            <DataArray type="Float64" Name="a" format="ascii">1 2 &xxe;</DataArray>
+            </PointData>
+            <Cells>
+            <DataArray type="Int64" Name="connectivity" format="ascii">0 1</DataArray>
+            <DataArray type="Int64" Name="offsets" format="ascii">2</DataArray>
+            <DataArray type="UInt8" Name="types" format="ascii">3</DataArray>
+            </Cells>
+            </Piece>
+            </UnstructuredGrid>
+            </VTKFile>
+            """
+        )
+    )
+    mesh = meshio.vtu.read(filename)
+    assert np.array_equal(mesh.point_data["a"], [1.0, 2.0])
+
+
+@pytest.mark.parametrize("mesh", [helpers.tri_mesh, helpers.polyhedron_mesh])
+def test_index_types(mesh, tmp_path):
+    # Small meshes are written with 32-bit indices and 8-bit cell types
+    filename = tmp_path / "test.vtu"
+    meshio.vtu.write(filename, mesh, binary=False)
+    content = filename.read_text()
+    names = ["connectivity", "offsets"]
+    if mesh is helpers.polyhedron_mesh:
+        names += ["faces", "faceoffsets"]
+    for name in names:
+        assert f'type="Int32" Name="{name}"' in content
+    assert 'type="UInt8" Name="types"' in content
+
+    mesh2 = meshio.vtu.read(filename)
+    for cells in mesh2.cells:
+        if cells.type.startswith("polyhedron"):
+            assert all(face.dtype == np.int32 for cell in cells.data for face in cell)
+        else:
+            assert cells.data.dtype == np.int32
+
+
+def test_index_dtype():
+    from meshio.vtu._vtu import _index_dtype
+
+    assert _index_dtype(0, 2**31 - 1) is np.int32
+    assert _index_dtype(2**31, 0) is np.int64
+    assert _index_dtype(10, 2**31) is np.int64
+
+
 def test_generic_io(tmp_path):
     helpers.generic_io(tmp_path / "test.vtu")
     # With additional, insignificant suffix:
@@ -78,3 +278,75 @@ def test_read_from_file(filename, ref_cells, ref_num_cells, ref_num_pnt):
     assert ref_cells == mesh.cells[0].type
     assert len(mesh.cells[0].data) == ref_num_cells
     assert len(mesh.points) == ref_num_pnt
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_read_wrapped_base64(compression, tmp_path):
+    # Some writers break the base64 text of inline binary data into lines
+    rng = np.random.default_rng(0)
+    mesh = meshio.Mesh(
+        rng.random((100, 3)),
+        [("triangle", rng.integers(0, 100, (50, 3)))],
+        cell_data={"a": [rng.random(50)]},
+    )
+    filename = tmp_path / "test.vtu"
+    meshio.vtu.write(filename, mesh, compression=compression)
+
+    lines = filename.read_text().split("\n")
+    wrapped = [
+        line if line.startswith("<") else "\n".join(textwrap.wrap(line, 76))
+        for line in lines
+    ]
+    assert wrapped != lines
+    filename.write_text("\n".join(wrapped))
+
+    mesh2 = meshio.vtu.read(filename)
+    assert np.array_equal(mesh.points, mesh2.points)
+    assert np.array_equal(mesh.cells[0].data, mesh2.cells[0].data)
+    assert np.array_equal(mesh.cell_data["a"][0], mesh2.cell_data["a"][0])
+
+
+@pytest.mark.parametrize("num_bytes", [20, 32])
+def test_inconsistent_data_size(num_bytes, tmp_path):
+    # The header of the point coordinates gives a partial item or more bytes than there
+    # are, the data holds the three coordinates of one point
+    data = base64.b64encode(
+        np.uint32(num_bytes).tobytes() + np.zeros(3, dtype="<f8").tobytes()
+    ).decode()
+    filename = tmp_path / "test.vtu"
+    filename.write_text(
+        textwrap.dedent(
+            f"""\
+            <?xml version="1.0"?>
+            <VTKFile type="UnstructuredGrid" version="0.1" byte_order="LittleEndian">
+            <UnstructuredGrid>
+            <Piece NumberOfPoints="1" NumberOfCells="1">
+            <Points>
+            <DataArray type="Float64" NumberOfComponents="3" format="binary">
+            {data}
+            </DataArray>
+            </Points>
+            <Cells>
+            <DataArray type="Int64" Name="connectivity" format="ascii">0</DataArray>
+            <DataArray type="Int64" Name="offsets" format="ascii">1</DataArray>
+            <DataArray type="UInt8" Name="types" format="ascii">1</DataArray>
+            </Cells>
+            </Piece>
+            </UnstructuredGrid>
+            </VTKFile>
+            """
+        )
+    )
+    with pytest.raises(meshio.ReadError, match="given in header"):
+        meshio.vtu.read(filename)
+
+
+def test_one_byte_array(tmp_path):
+    # The header encoded together with a single byte of data ends in "=", just like a
+    # separately encoded header
+    mesh = helpers.add_cell_data(helpers.tri_mesh_one_cell, [("a", (), np.int8)])
+
+    def writer(*args, **kwargs):
+        return meshio.vtu.write(*args, compression=None, **kwargs)
+
+    helpers.write_read(tmp_path, writer, meshio.vtu.read, mesh, 0.0)